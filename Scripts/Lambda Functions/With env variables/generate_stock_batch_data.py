@@ -1,3 +1,78 @@
+import os
+import logging
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.fs as pa_fs
+from datetime import datetime, timedelta
+from random import randrange
+
+
+#create a logger object
+logger = logging.getLogger()
+
+"""A logger handler in Python's logging module is a component that determines
+where the log messages go — such as a file, console, email,
+or an external service like AWS CloudWatch.
+AWS Lambda already has a preconfigured handler. 
+What is not preconfigured though is the log-level.
+So the if condition below checks if the logger object has an object, 
+if yes (in case of AWS lambda) then just set the logging level
+"""
+#create and configure logging
+if logger.hasHandlers():
+    logger.setLevel(logging.INFO)
+else:   
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+#read once when the lambda container starts, a missing variable fails the cold start with a KeyError
+dest_bucket_path = os.environ['dest_bucket_path']
+
+#the S3 filesystem (and its credentials) is created once per lambda container and reused by the warm invocations,
+#the upload is retried up to 10 times on S3 SlowDown and other transient errors instead of failing
+s3_filesystem = pa_fs.S3FileSystem(retry_strategy = pa_fs.AwsStandardS3RetryStrategy(max_attempts = 10))
+
+
+#get the current stock prices of some companies on 25/01/2025
+companies_price = {
+                    'NVDA': 143,
+                    'AAPL': 223,
+                    'MSFT': 444,
+                    'AMZN': 234,
+                    'GOOGL': 200,
+                    'META': 647,
+                    'TSLA': 407,
+                    'WMT': 95,
+                    'JPM': 265,
+                    'V': 330,
+                    'ORCL': 184,
+                    'MA': 490,
+                    'XOM': 109,
+                    'NFLX': 978,
+                    'PG': 164,
+                    'SAP': 276
+                    }
+
+#the companies, their price ranges and the date range never change, so they are computed once per lambda container
+companies = list(companies_price.keys())
+current_prices = np.array(list(companies_price.values()), dtype=np.int32)
+
+#create a min and max price for each current price by adding and removing 10% from the current price
+#astype truncates like int() did, so the ranges are the same as before
+min_prices = (current_prices * 0.9).astype(np.int32)
+max_prices = (current_prices * 1.1).astype(np.int32)
+
+#the random dates are generated between 1/1/2022 and 31/12/2024
+date_1 = datetime.strptime('01-01-2022', '%d-%m-%Y')
+date_2 = datetime.strptime('31-12-2024', '%d-%m-%Y')
+days_diff_integer = (date_2 - date_1).days
+
+
 def generate_stock_batch_data(event = None, context = None):
     """
     
@@ -13,7 +88,8 @@ def generate_stock_batch_data(event = None, context = None):
 
     Libraries used:
     - pandas: For dataframe creation
-    - awswrangler: For writing to S3
+    - numpy: For generating the random prices of all the companies at once
+    - pyarrow: For writing the CSV file to S3
     - datetime & random: For date and value simulation
     - logging: For debugging and error tracing
 
@@ -36,104 +112,25 @@ def generate_stock_batch_data(event = None, context = None):
     Outputs a CSV file to the staging S3 bucket.
     """
 
-    
-    import logging
-
-    logger = logging.getLogger()
-
-    """A logger handler in Python's logging module is a component that determines
-    where the log messages go — such as a file, console, email,
-    or an external service like AWS CloudWatch.
-    AWS Lambda already has a preconfigured handler. 
-    What is not preconfigured though is the log-level.
-    So the if condition below checks if the logger object has an object, 
-    if yes (in case of AWS lambda) then just set the logging level
-    """
-    #create and configure logging
-    if logger.hasHandlers():
-        logger.setLevel(logging.INFO)
-    else:   
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S"
-        )
- 
-
-    try:
-    
-        import os
-        import awswrangler as wr
-        import pandas as pd
-        from datetime import datetime, timedelta
-        from random import randrange
-            
-    
-    except Exception as e:
-        logger.error(f'Error when importing one of the libraries: {type(e).__name__} - {e}')
-        raise #terminate the program
-     
-
-    #get the current stock prices of some companies on 25/01/2025
-    companies_price = {
-                        'NVDA': {'current_price':143},
-                        'AAPL': {'current_price':223},
-                        'MSFT': {'current_price':444},
-                        'AMZN': {'current_price':234},
-                        'GOOGL': {'current_price':200},
-                        'META': {'current_price':647},
-                        'TSLA': {'current_price':407},
-                        'WMT': {'current_price':95},
-                        'JPM': {'current_price':265},
-                        'V': {'current_price':330},
-                        'ORCL': {'current_price':184},
-                        'MA': {'current_price':490},
-                        'XOM': {'current_price':109},
-                        'NFLX': {'current_price':978},
-                        'PG': {'current_price':164},
-                        'SAP': {'current_price':276}
-                        }
-    
-    #create a min and max price for each current price by adding and removing 10% from the current price
-    for k in companies_price:
-        companies_price[k]['min_price'] = int(companies_price[k]['current_price'] * 0.9)
-        companies_price[k]['max_price'] = int(companies_price[k]['current_price'] * 1.1)
-        
     #create a random date between 1/1/2022 and 31/12/2024
-
-    date_1 = datetime.strptime('01-01-2022', '%d-%m-%Y')
-    date_2 = datetime.strptime('31-12-2024', '%d-%m-%Y')
-
-    days_diff_integer = (date_2 - date_1).days
     random_days = randrange(days_diff_integer)
     random_date = date_1 + timedelta(days = random_days)
     random_date = random_date.strftime('%Y-%m-%d') 
     
-    #generate a random closing pricing between the min and the max prices, and add the random_date generated in the previous step
-    for k in companies_price:
-        min_price = companies_price[k]['min_price']
-        max_price = companies_price[k]['max_price']
-        companies_price[k]['date'] = random_date
-        companies_price[k]['close_price'] = randrange(min_price, max_price)
-        
-    #delete the keys min_price, max_price and current_price since they're not needed anymore
-        del companies_price[k]['min_price'] 
-        del companies_price[k]['max_price']
-        del companies_price[k]['current_price']    
+    #generate all the random closing prices between the min (inclusive) and the max (exclusive) prices in one call
+    close_prices = np.random.randint(min_prices, max_prices)
 
     
     logger.debug('creating the dataframe')
     
     try:
-        #create the dataframe
-        df = pd.DataFrame.from_dict(companies_price, orient='index')
-        df.reset_index(inplace = True)
-        df.rename(columns={'index': 'company'}, inplace = True)
+        #create the dataframe column by column, the random_date generated in the previous step is shared by all the rows
+        df = pd.DataFrame({'company': companies, 'date': random_date, 'close_price': close_prices})
         df_count = str(df.shape[0])
      
     except Exception as e:
        
-        logger.error(f'Error when creating the dataframe from the dictionary {type(e).__name__} {e}')
+        logger.error(f'Error when creating the dataframe from the generated prices {type(e).__name__} {e}')
         raise
     
     logger.debug('dataframe created')
@@ -144,9 +141,13 @@ def generate_stock_batch_data(event = None, context = None):
         #export the csv to s3
         today = datetime.today()
         file_name = datetime.strftime(today, '%Y%m%d%H%M%S')
-        dest_bucket_path = os.environ['dest_bucket_path'] #get the value of the environment value
         path = f'{dest_bucket_path}{file_name}.csv'
-        wr.s3.to_csv( df = df, path = path, index = False)
+        
+        #pyarrow's csv writer formats the columns in C++ and streams the file to S3 (multipart for big files),
+        #quoting_style='none' writes the values without quotes like pandas does (the header is always quoted)
+        with s3_filesystem.open_output_stream(path.removeprefix('s3://')) as file:
+            pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index = False), file,
+                             write_options = pa_csv.WriteOptions(quoting_style = 'none'))
      
     except Exception as e:
         logger.error(f'Error when exporting the file {type(e).__name__} {e}')
@@ -1,3 +1,68 @@
+import logging
+import os
+import uuid
+from datetime import datetime
+
+
+#create a logger object
+logger = logging.getLogger()
+
+"""
+botocore.credentials is a library-specific logger inside the AWS SDK — logs internal activity, like how it loads credentials.
+it is different than the logger being created above logger = logging.getLogger()
+Why are there multiple loggers?
+The logging module supports a hierarchical naming system, allowing you to control logging granularly:
+logging.getLogger() → the root logger
+logging.getLogger('my_app') → custom logger for your code
+logging.getLogger('botocore.credentials') → logger for AWS SDK internals
+This way, you can filter logs from third-party libraries without muting your own logs.
+"""
+#Only show WARNING and above from botocore.credentials, ignore INFO like the ‘Found credentials’ message.
+logging.getLogger('botocore.credentials').setLevel(logging.WARNING) 
+
+"""A logger handler in Python's logging module is a component that determines
+where the log messages go — such as a file, console, email,
+or an external service like AWS CloudWatch.
+AWS Lambda already has a preconfigured handler. 
+What is not preconfigured though is the log-level.
+So the if condition below checks if the logger object has an object, 
+if yes (in case of AWS lambda) then just set the logging level
+"""
+#configure the logging object
+if logger.hasHandlers():
+    logger.setLevel(logging.INFO)
+else:   
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+#read once when the lambda container starts, a missing variable fails the cold start with a KeyError
+dest_bucket_path = os.environ['dest_bucket_path']
+
+#the boto3 session is created by the first invocation that has a file to process and reused by the warm invocations,
+#awswrangler would otherwise create a new session (credentials resolution and service model loading) for every call
+boto3_session = None
+
+#pyarrow's S3 filesystem (used for reading the csv file and writing the parquet files) is created and reused the same way,
+#its requests are retried up to 10 times on S3 SlowDown and other transient errors instead of failing the job
+s3_filesystem = None
+
+
+#this function builds the summary that the handler returns at every exit point,
+#the duration of the job is measured from start_time until the summary is built
+def job_summary(status, records_appended, start_time):
+    
+    duration = round((datetime.now() - start_time).total_seconds(),0)
+    
+    return {
+    "status": status,
+    "records_appended": records_appended,
+    "duration_seconds": duration
+            }
+
+
 def process_batch_files_lambda(event, context):
 
     """
@@ -9,7 +74,7 @@ def process_batch_files_lambda(event, context):
     4. Appends only new records to a partitioned Parquet dataset on S3.
     
     Environment Variable:
-    - dest_bucket_path: S3 path to save cleaned parquet files (must end with '/')
+    - dest_bucket_path: S3 path to save cleaned parquet files (with or without a trailing '/')
     
     Parameters:
     - event: dict, AWS Lambda event (S3 PUT)
@@ -21,107 +86,85 @@ def process_batch_files_lambda(event, context):
     os            → To fetch environment variables
     pandas        → For data manipulation and cleaning
     datetime      → To handle timestamps and date logic
-    awswrangler   → For interaction with AWS services (S3, Athena)  
+    awswrangler   → For querying the existing records with Athena
+    pyarrow       → For reading the csv file from S3 and writing the partitioned parquet files
     
     """
 
-
-    
-    
-    import logging
-    import os
-    import pandas as pd
-    from datetime import datetime, timedelta
-    import awswrangler as wr
-
-          
     # Start timestamp
     start_time = datetime.now()
     
-    #create a logger object
-    logger = logging.getLogger()
-    
-    """
-    botocore.credentials is a library-specific logger inside the AWS SDK — logs internal activity, like how it loads credentials.
-    it is different than the logger being created above logger = logging.getLogger()
-    Why are there multiple loggers?
-    The logging module supports a hierarchical naming system, allowing you to control logging granularly:
-    logging.getLogger() → the root logger
-    logging.getLogger('my_app') → custom logger for your code
-    logging.getLogger('botocore.credentials') → logger for AWS SDK internals
-    This way, you can filter logs from third-party libraries without muting your own logs.
-    """
-    #Only show WARNING and above from botocore.credentials, ignore INFO like the ‘Found credentials’ message.
-    logging.getLogger('botocore.credentials').setLevel(logging.WARNING) 
-
-    """A logger handler in Python's logging module is a component that determines
-    where the log messages go — such as a file, console, email,
-    or an external service like AWS CloudWatch.
-    AWS Lambda already has a preconfigured handler. 
-    What is not preconfigured though is the log-level.
-    So the if condition below checks if the logger object has an object, 
-    if yes (in case of AWS lambda) then just set the logging level
-    """
-    #configure the logging object
-    if logger.hasHandlers():
-        logger.setLevel(logging.INFO)
-    else:   
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S"
-        )        
-            
-            
     source_bucket = event['Records'][0]['s3']['bucket']['name']
     key = event['Records'][0]['s3']['object']['key']
     path = f"s3://{source_bucket}/{key}"
     
-    try:
-        dest_bucket_path = os.environ['dest_bucket_path']
-    except Exception as e:
-        logger.error(f'Error when reading the environment variable of the destination path {type(e).__name__} - {e}')
-        raise #terminate the program
-       
+    #the S3 event already carries the object size, so an empty file is detected without reading it
+    if event['Records'][0]['s3']['object']['size'] == 0:
+        logger.warning(f"Ingested file {path} is empty. Exiting job early.")
+        
+        return job_summary("success with warning", 0, start_time)
+    
+    #awswrangler (which loads boto3, pyarrow and numpy) and pandas are only imported once there is a non-empty file to process.
+    #they are cached in sys.modules after the first import, so warm invocations do not import them again
+    import awswrangler as wr
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as pa_ds
+    import pyarrow.fs as pa_fs
+    import boto3
+    from botocore.config import Config
+    
+    global boto3_session, s3_filesystem
+    if boto3_session is None:
+        boto3_session = boto3.session.Session()
+        
+        #adaptive retries slow the requests down on S3 SlowDown and Athena throttling errors instead of failing the job,
+        #and 50 pooled connections let the threads of awswrangler run in parallel (the default is 10)
+        wr.config.botocore_config = Config(retries = {'mode': 'adaptive', 'max_attempts': 10}, max_pool_connections = 50)
+        
+        s3_filesystem = pa_fs.S3FileSystem(retry_strategy = pa_fs.AwsStandardS3RetryStrategy(max_attempts = 10))
     
     logger.debug(f'reading {path}')
     
     try:
-        df_new_file = wr.s3.read_csv(path)
-        df_new_file_records_count = df_new_file.shape[0]
+        """
+        The file is a single csv object with a known layout, so it is read directly with pyarrow's csv reader,
+        which skips the extra passes awswrangler adds on top of pandas.read_csv.
+        All the columns are read as strings so that no type inference is needed. The cleaning below converts
+        them and still turns the values that cannot be converted to NaN/NaT instead of failing the whole file.
+        A row with a missing or an extra field would fail the whole read, so it is skipped by invalid_row_handler
+        instead and counted with the bad records.
+        """
+        invalid_rows = []
+        
+        def skip_invalid_row(row):
+            invalid_rows.append(row.number)
+            
+            return 'skip'
+        
+        with s3_filesystem.open_input_stream(f'{source_bucket}/{key}') as file:
+            df_new_file = pa_csv.read_csv(file, parse_options = pa_csv.ParseOptions(invalid_row_handler = skip_invalid_row),
+                                          convert_options = pa_csv.ConvertOptions(
+                                                                    column_types = {'company': pa.string(),
+                                                                                    'date': pa.string(),
+                                                                                    'close_price': pa.string()})
+                                          ).to_pandas()
+        
+        df_new_file_records_count = df_new_file.shape[0] + len(invalid_rows)
         
     except Exception as e:
         logger.error(f'Error when reading the csv file from the path {path} {type(e).__name__} - {e}')
         raise #terminate the program
     
-    if df_new_file.shape[0] == 0:
+    if df_new_file_records_count == 0:
         logger.warning("Ingested file is empty. Exiting job early.")
         
-        end_time = datetime.now()
-        duration = round((end_time - start_time).total_seconds(),0)
-        
-        return {
-        "status": "success with warning",
-        "records_appended": 0,
-        "duration_seconds": duration
-                }
+        return job_summary("success with warning", 0, start_time)
 
     
     logger.info(f'reading from {path} and dataframe creation successful. {df_new_file_records_count} records ingested')
     
-    logger.debug('reading data using athena')
-    
-    try:
-        df_athena = wr.athena.read_sql_query('SELECT * FROM price_by_date', database = 'stock_market')
-        
-    except Exception as e:
-        logger.error(f'Error when reading data using athena {type(e).__name__} - {e}')
-        raise #terminate the program
-
- 
-    logger.debug('reading using athena successful')
-    
-    
     try:
         logger.debug(f'cleaning {path} if needed')
         
@@ -130,7 +173,8 @@ def process_batch_files_lambda(event, context):
         #convert to integer and convert records that cannot be converted to NaN
         df_new_file['close_price'] = pd.to_numeric(df_new_file['close_price'], errors='coerce') 
         
-        bad_records_count = df_new_file['close_price'].isna().sum()
+        #the malformed rows skipped by the csv reader are bad records too
+        bad_records_count = len(invalid_rows) + df_new_file['close_price'].isna().sum()
         
         #remove null close_price records
         df_new_file = df_new_file.dropna(subset=['close_price'])  
@@ -144,8 +188,10 @@ def process_batch_files_lambda(event, context):
         logger.debug('cleaning the date column')
         
         
-        #convert string date to date object and replace dates that cannot be converted to NAN (errors='coerce')
-        df_new_file['date'] = pd.to_datetime(df_new_file['date'], errors='coerce').dt.date 
+        #convert string date to datetime64 and replace dates that cannot be converted to NaT (errors='coerce').
+        #the column stays datetime64 instead of python date objects (one object per row), it is cast to DATE when written
+        #the explicit format keeps pandas on its vectorized parser instead of falling back to parsing element by element
+        df_new_file['date'] = pd.to_datetime(df_new_file['date'], errors='coerce', format='%Y-%m-%d')
         
         bad_records_count = bad_records_count + df_new_file['date'].isna().sum()
         
@@ -158,34 +204,124 @@ def process_batch_files_lambda(event, context):
         
         logger.debug('cleaning the company column')
         
-        df_new_file['company'] = df_new_file['company'].astype('object')
+        #only a handful of companies exist, so a categorical column stores one small integer code per row instead of
+        #one python string, which is also what the categorical company column read from athena is compared with
+        df_new_file['company'] = df_new_file['company'].astype('category')
         
         logger.debug('done cleaning the company column')
         
         logger.info(f"Number of records with bad data: {bad_records_count}")
+    
+    except Exception as e:
+        logger.error(f'error during cleaning {type(e).__name__} - {e}')
+        raise #terminate the program
+    
+    
+    logger.debug('reading data using athena')
+    
+    """
+    Only the (company, date) pairs of the ingested file can already exist in the table, so instead of reading
+    the whole table (which grows with every file) athena only returns the existing keys for the dates and
+    companies found in the file. The result can contain a few pairs that are not in the file
+    (e.g. a company of the file on another date of the file), the join below ignores them.
+    The dates and companies are passed as query parameters so that awswrangler escapes them.
+    The table is partitioned by p_year, athena only prunes the partitions with a plain IN list on the
+    partition column (not with contains), so the years of the file are written in the query as integers.
+    """
+    existing_records_query = 'SELECT company, close_date \
+                              FROM price_by_date \
+                              WHERE p_year IN ({years}) \
+                              AND contains(:dates, close_date) \
+                              AND contains(:companies, company)'
+    
+    try:
+        if df_new_file.shape[0] > 0:
+            #categories reads company as a categorical column instead of one python string per row,
+            #keep_files=False deletes the CTAS result files from the athena results bucket once they are read
+            file_dates = df_new_file['date'].drop_duplicates()
+            file_years = ', '.join(str(year) for year in sorted(file_dates.dt.year.unique().tolist()))
+            
+            df_athena = wr.athena.read_sql_query(existing_records_query.format(years = file_years), database = 'stock_market',
+                                                 params = {'dates': file_dates.dt.date.tolist(),
+                                                           'companies': df_new_file['company'].unique().tolist()},
+                                                 categories = ['company'],
+                                                 keep_files = False,
+                                                 use_threads = True,
+                                                 boto3_session = boto3_session)
+        else:
+            #all the records were bad, there is nothing to compare
+            df_athena = pd.DataFrame(columns=['company', 'close_date'])
+        
+    except Exception as e:
+        logger.error(f'Error when reading data using athena {type(e).__name__} - {e}')
+        raise #terminate the program
+
  
+    logger.debug('reading using athena successful')
+    
+    try:
         logger.debug('checking if new records exist')     
         
-        # Perform the left join and get records in df_new_file and not in df_athena
-        merged_df = pd.merge(df_new_file, df_athena, how='left', left_on=['company', 'date'], right_on=['company', 'close_date'])
-        df_new_records = merged_df[merged_df['close_price_y'].isnull()][['company', 'date', 'close_price_x']]
+        #athena returns close_date as python date objects, convert them to datetime64 like the date column of df_new_file
+        df_athena['close_date'] = pd.to_datetime(df_athena['close_date'])
+        
+        #keep the records of df_new_file whose (company, date) pair is not in df_athena.
+        #isin on a MultiIndex is a hash lookup, unlike a left join it does not build a merged copy of both dataframes
+        new_keys = pd.MultiIndex.from_arrays([df_new_file['company'], df_new_file['date']])
+        existing_keys = pd.MultiIndex.from_arrays([df_athena['company'], df_athena['close_date']])
+        
+        df_new_records = df_new_file.loc[~new_keys.isin(existing_keys), ['company', 'date', 'close_price']]
+        df_new_records = df_new_records.rename(columns={'date': 'close_date'})
         df_new_records_count = df_new_records.shape[0]
     
     except Exception as e:
-        logger.error(f'error during cleaning or when checking if new records exist {type(e).__name__} - {e}')
+        logger.error(f'error when checking if new records exist {type(e).__name__} - {e}')
         raise #terminate the program
     
     
     if df_new_records_count > 0:
          
         logger.info(f'{df_new_records_count} records will be appended')
-        
-        df_new_records.columns = ['company', 'close_date', 'close_price']
 
         try:
-            #create the partition column
-            df_new_records['p_year'] = pd.to_datetime(df_new_records['close_date']).dt.year
-            wr.s3.to_parquet(df=df_new_records, path=dest_bucket_path, index=False, dataset=True, partition_cols=['p_year'])
+            #create the partition column, casting datetime64 to datetime64[Y] counts the years since 1970 in numpy
+            df_new_records['p_year'] = df_new_records['close_date'].to_numpy().astype('datetime64[Y]').astype('int32') + 1970
+            
+            #the schema is given instead of inferred from the dataframe, close_date is written as DATE and close_price
+            #as BIGINT (same data types of the target table), company is dictionary encoded (the categorical codes)
+            batch_schema = pa.schema([('company', pa.dictionary(pa.int32(), pa.string())),
+                                      ('close_date', pa.date32()),
+                                      ('close_price', pa.int64()),
+                                      ('p_year', pa.int32())])
+            
+            table = pa.Table.from_pandas(df_new_records, schema=batch_schema, preserve_index=False)
+            
+            #zstd files are smaller than snappy ones for a similar cpu cost, so athena scans less data
+            parquet_options = pa_ds.ParquetFileFormat().make_write_options(compression = 'zstd',
+                                                                           compression_level = 3,
+                                                                           use_dictionary = ['company'],
+                                                                           data_page_size = 1024 * 1024)
+            
+            """
+            pyarrow's dataset writer splits the table into the p_year=YYYY folders and streams each partition
+            through one parquet file writer, the arrow table is written as is without another pandas copy.
+            - basename_template: a new uuid per invocation so the files of previous loads are never overwritten
+            - existing_data_behavior: keep the files already in the partition folders (append)
+            - max_rows_per_file/max_rows_per_group: at most 1 million rows per file, written as one row group
+            - create_dir: S3 has no directories, so no empty folder marker objects are created
+            """
+            pa_ds.write_dataset(table,
+                                base_dir = dest_bucket_path.removeprefix('s3://'),
+                                filesystem = s3_filesystem,
+                                format = 'parquet',
+                                file_options = parquet_options,
+                                partitioning = ['p_year'],
+                                partitioning_flavor = 'hive',
+                                basename_template = f'{uuid.uuid4().hex}-{{i}}.parquet',
+                                existing_data_behavior = 'overwrite_or_ignore',
+                                max_rows_per_file = 1_000_000,
+                                max_rows_per_group = 1_000_000,
+                                create_dir = False)
             
         except Exception as e:
             logger.error(f'Error creating the partition column or when writing the file to {path} {type(e).__name__} - {e}')
@@ -195,46 +331,31 @@ def process_batch_files_lambda(event, context):
         records_difference = df_new_file_records_count - df_new_records_count
         
         if records_difference == 0:
-            end_time = datetime.now()
-            duration = round((end_time - start_time).total_seconds(),0)
+            summary = job_summary("success", df_new_records_count, start_time)
             
             logger.info(f'all records ({df_new_records_count}) got appended successfully to the table stock_market.price_by_date.\
-                        Total time taken: {duration} seconds. ETL job will exit.')
+                        Total time taken: {summary["duration_seconds"]} seconds. ETL job will exit.')
                         
-            return {
-            "status": "success",
-            "records_appended": df_new_records_count,
-            "duration_seconds": duration
-                    }
+            return summary
         
         else:
             logger.warning(f'destination records are less than the source records by {records_difference}')
             
-            end_time = datetime.now()
-            duration = round((end_time - start_time).total_seconds(),0)
+            summary = job_summary("success with warning", df_new_records_count, start_time)
             
             logger.info(f'{df_new_records_count}/{df_new_file_records_count} records got appended successfully \
-            to the table stock_market.price_by_date. Total time taken: {duration} seconds. ETL job will exit.')
+            to the table stock_market.price_by_date. Total time taken: {summary["duration_seconds"]} seconds. ETL job will exit.')
                     
-            return {
-            "status": "success with warning",
-            "records_appended": df_new_records_count,
-            "duration_seconds": duration
-                    }
+            return summary
         
             
     else:
-        end_time = datetime.now()
-        duration = round((end_time - start_time).total_seconds(),0)
+        summary = job_summary("success with warning", 0, start_time)
         
         logger.warning(f'No new records found after comparing the ingested data with the table stock_market.price_by_date \
-        Total time taken: {duration} seconds. ETL job will exit.')
+        Total time taken: {summary["duration_seconds"]} seconds. ETL job will exit.')
         
-        return {
-        "status": "success with warning",
-        "records_appended": 0,
-        "duration_seconds": duration
-                }
+        return summary
     
     
     
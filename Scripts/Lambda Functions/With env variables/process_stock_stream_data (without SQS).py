@@ -1,208 +1,357 @@
-def process_stock_stream_data(event, context):
+import os
+import io
+import uuid
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+
+#create a logger object
+logger = logging.getLogger()
+
+
 """
-this function is similar to the code in process_stock_stream_data.py but gets triggered 
-by S3 put events instead of a stream of events in SQS.
+botocore.credentials is a library-specific logger inside the AWS SDK — logs internal activity, like how it loads credentials.
+it is different than the logger being created above logger = logging.getLogger()
+Why are there multiple loggers?
+The logging module supports a hierarchical naming system, allowing you to control logging granularly:
+logging.getLogger() → the root logger
+logging.getLogger('my_app') → custom logger for your code
+logging.getLogger('botocore.credentials') → logger for AWS SDK internals
+This way, you can filter logs from third-party libraries without muting your own logs.
 """
-    
-    import os
-    import json
-    import boto3
-    import awswrangler as wr
-    import pandas as pd
-    from datetime import datetime
-    import logging
-    
-    # Start timestamp
-    start_time = datetime.now()
+#Only show WARNING and above from botocore.credentials, ignore INFO like the ‘Found credentials’ message.
+logging.getLogger('botocore.credentials').setLevel(logging.WARNING) 
+
+"""A logger handler in Python's logging module is a component that determines
+where the log messages go — such as a file, console, email,
+or an external service like AWS CloudWatch.
+AWS Lambda already has a preconfigured handler. 
+What is not preconfigured though is the log-level.
+So the if condition below checks if the logger object has an object, 
+if yes (in case of AWS lambda) then just set the logging level
+"""
+#configure the logging object
+if logger.hasHandlers():
+    logger.setLevel(logging.INFO)
+else:   
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+
+#read once when the lambda container starts, a missing variable fails the cold start with a KeyError
+dest_bucket_path = os.environ['dest_bucket_path']
+dest_bucket_path_overwrite = os.environ['dest_bucket_path_overwrite']
+
+#the latest prices snapshot is a single parquet file, it is read and overwritten with its bucket and key
+latest_bucket, _, latest_key = dest_bucket_path_overwrite.removeprefix('s3://').partition('/')
+
+#number of times the latest prices are merged again when another invocation replaced the snapshot in the meantime
+latest_max_attempts = 5
+
+#parquet files of the history bigger than 16 MiB are uploaded as 16 MiB parts by up to 16 threads
+transfer_config = TransferConfig(multipart_threshold = 16 * 1024 * 1024,
+                                 multipart_chunksize = 16 * 1024 * 1024,
+                                 max_concurrency = 16,
+                                 use_threads = True)
+
+#partitions of the history with more records are split into several files, athena reads the files of a partition in parallel
+max_rows_per_file = 500_000
+
+#adaptive retries slow the requests down on S3 SlowDown errors instead of failing the batch,
+#and 50 pooled connections let the threads of the transfer manager run in parallel (the default is 10)
+botocore_config = Config(retries = {'mode': 'adaptive', 'max_attempts': 10}, max_pool_connections = 50)
+
+#the session and the client are created once per lambda container and reused by the warm invocations,
+#instead of resolving the credentials and loading the service model again for every call
+boto3_session = boto3.session.Session()
+s3_client = boto3_session.client('s3', config = botocore_config)
+
+#pyarrow's S3 filesystem (used for reading the json files) and the schema of the stream records are created by the first
+#invocation that has a file to process, after pyarrow is imported, and reused the same way by the warm invocations.
+#its requests are retried up to 10 times on S3 SlowDown and other transient errors instead of failing the batch
+s3_filesystem = None
+stream_schema = None
 
-    #create a logger object
-    logger = logging.getLogger()
+
+#this function builds the summary that the handler returns at every exit point,
+#the duration of the job is measured from start_time until the summary is built
+def job_summary(status, records_appended, start_time):
     
+    duration = round((datetime.now() - start_time).total_seconds(),0)
     
+    return {
+    "status": status,
+    "records_appended": records_appended,
+    "duration_seconds": duration
+            }
+
+
+def process_stock_stream_data(event, context):
     """
-    botocore.credentials is a library-specific logger inside the AWS SDK — logs internal activity, like how it loads credentials.
-    it is different than the logger being created above logger = logging.getLogger()
-    Why are there multiple loggers?
-    The logging module supports a hierarchical naming system, allowing you to control logging granularly:
-    logging.getLogger() → the root logger
-    logging.getLogger('my_app') → custom logger for your code
-    logging.getLogger('botocore.credentials') → logger for AWS SDK internals
-    This way, you can filter logs from third-party libraries without muting your own logs.
-    """
-    #Only show WARNING and above from botocore.credentials, ignore INFO like the ‘Found credentials’ message.
-    logging.getLogger('botocore.credentials').setLevel(logging.WARNING) 
-
-    """A logger handler in Python's logging module is a component that determines
-    where the log messages go — such as a file, console, email,
-    or an external service like AWS CloudWatch.
-    AWS Lambda already has a preconfigured handler. 
-    What is not preconfigured though is the log-level.
-    So the if condition below checks if the logger object has an object, 
-    if yes (in case of AWS lambda) then just set the logging level
+    this function is similar to the code in process_stock_stream_data.py but gets triggered 
+    by S3 put events instead of a stream of events in SQS.
     """
-    #configure the logging object
-    if logger.hasHandlers():
-        logger.setLevel(logging.INFO)
-    else:   
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S"
-        )   
-        
-            
+    
+    # Start timestamp
+    start_time = datetime.now()
     
     #get the source path of the json file that will be read
     source_bucket = event['Records'][0]['s3']['bucket']['name']
     key = event['Records'][0]['s3']['object']['key']
     path = f's3://{source_bucket}/{key}'
     
-    try:
-        #read the json file as a data frame
-        df = wr.s3.read_json(path = path, lines=True) #lines=True is used to treat each line as the delimiter
-    except Exception as e:
-        logger.error(f'Error when reading the input stream data from {path}  {type(e).__name__} - {e}')
-        raise #terminate the program
+    #the S3 event already carries the object size, so an empty file is detected without reading it
+    if event['Records'][0]['s3']['object']['size'] == 0:
+        logger.warning(f"Ingested file {path} is empty. Exiting job early.")
+        
+        return job_summary("success with warning", 0, start_time)
     
-    try:
-        dest_bucket_path_overwrite = os.environ['dest_bucket_path_overwrite']
-    except Exception as e:
-        logger.error(f'Error when reading the environment variable of the overwrite \
-        destination path: {dest_bucket_path_overwrite}  {type(e).__name__} - {e}')
-        raise #terminate the program
+    #pandas, pyarrow and numpy are only imported once there is a non-empty file to process.
+    #they are cached in sys.modules after the first import, so warm invocations do not import them again
+    import pandas as pd
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.json as pa_json
+    import pyarrow.parquet as pa_pq
+    import pyarrow.fs as pa_fs
+    
+    """
+    the schema of the records written by write_records_to_stream is passed to the json reader instead of being inferred:
+    columns missing from the file are filled with nulls, and produced_at is read as a string so that a badly formatted
+    timestamp is dropped by the transformations instead of failing the read
+    """
+    global s3_filesystem, stream_schema
+    if s3_filesystem is None:
+        s3_filesystem = pa_fs.S3FileSystem(connect_timeout = 5, request_timeout = 30,
+                                           retry_strategy = pa_fs.AwsStandardS3RetryStrategy(max_attempts = 10))
+        stream_schema = pa.schema([('symbol', pa.string()), ('price', pa.int64()), ('produced_at', pa.string())])
+    
+    def read_stream_file(path):
+        """
+        reads one json file of the stream with stream_schema. a price that is not an integer (e.g. "n/a" or 12.5)
+        fails the whole arrow read, so such a file is parsed again with pandas and its prices are converted with
+        pd.to_numeric(errors='coerce'): prices that are not numbers become null and are dropped (and counted) as bad records
+        by the transformations, and fractional prices are truncated to int64. the other files never take this slower path
+        """
+        with s3_filesystem.open_input_stream(path.removeprefix('s3://')) as file:
+            data = file.read()
+        
+        try:
+            #the file is read in 8 MiB blocks that are parsed by several threads
+            return pa_json.read_json(pa.BufferReader(data), read_options = pa_json.ReadOptions(block_size = 8 << 20),
+                                     parse_options = pa_json.ParseOptions(explicit_schema = stream_schema)).select(stream_schema.names)
+        except pa.ArrowInvalid as e:
+            logger.warning(f'{path} has records that do not match the stream schema ({e}), converting them with pandas')
+        
+        df = pd.read_json(io.BytesIO(data), lines = True, dtype = False, convert_dates = False).reindex(columns = stream_schema.names)
+        price = pd.to_numeric(df['price'], errors = 'coerce')
+        
+        return pa.table({'symbol': pa.array(df['symbol'].astype('string'), type = pa.string(), from_pandas = True),
+                         'price': pa.array(price, type = pa.float64(), from_pandas = True).cast(pa.int64(), safe = False),
+                         'produced_at': pa.array(df['produced_at'].astype('string'), type = pa.string(), from_pandas = True)})
     
     try:
-        dest_bucket_path = os.environ['dest_bucket_path']
+        #read the json file with pyarrow's json reader, it parses the line-delimited records in C++ into arrow columns
+        #instead of going through pandas.read_json
+        table = read_stream_file(path)
     except Exception as e:
-        logger.error(f'Error when reading the environment variable of the \
-        destination path: {dest_bucket_path}  {type(e).__name__} - {e}')
+        logger.error(f'Error when reading the input stream data from {path}  {type(e).__name__} - {e}')
         raise #terminate the program
+    
         
         
-    try:
-        df_athena_test = wr.athena.read_sql_query(
-            sql="SELECT 1 test_column from stream_prices_history \
-            union all \
-            SELECT 1 test_column from latest_prices",  
-            database="stock_market"
-        )
-    except Exception as e:
-        logger.error(f'athena connection failed or one of the destination tables do not exist {type(e).__name__} - {e}')
-        raise  
       
          
-    if df.shape[0] == 0:
+    if table.num_rows == 0:
         logger.warning("Ingested file is empty. Exiting job early.")
         
-        end_time = datetime.now()
-        duration = round((end_time - start_time).total_seconds(),0)
-        
-        return {
-        "status": "success with warning",
-        "records_appended": 0,
-        "duration_seconds": duration
-                }
+        return job_summary("success with warning", 0, start_time)
     
     
    
+    """
+    the records stay in the arrow table that was read from the json files: the transformations below are pyarrow.compute
+    kernels over whole columns and the history is written from the same table, so the batch is never converted
+    to a pandas dataframe and back to arrow. only the latest record per symbol is converted to pandas
+    """
     try:
         #Apply Transformations
 
-        #convert to integer and convert records that cannot be converted to NaN
-        df['price'] = pd.to_numeric(df['price'], errors='coerce') 
-        
-        bad_records_count = df['price'].isna().sum()
-        
-        #remove null price records
-        df = df.dropna(subset=['price'])  
-        
-        #convert to int64 because it is equivalent to BIGINT in athena (same data type of the target table)
-        df['price'] = df['price'].astype('int64')  
-
-        #convert string date time to date time object and replace date time that cannot be converted to NAN (errors='coerce')
-        df['produced_at'] = pd.to_datetime(df['produced_at'], errors='coerce')
+        #convert string date time to a timestamp and replace date time that cannot be converted with null (error_is_null),
+        #the format is the one used by write_records_to_stream and ms is the precision stored in parquet
+        produced_at = pc.strptime(table['produced_at'], format = '%Y-%m-%d %H:%M:%S', unit = 'ms', error_is_null = True)
         
-        bad_records_count = bad_records_count + df['produced_at'].isna().sum()
+        #a record is bad if its price is missing or is not a number (null after read_stream_file) or its date could not be converted,
+        #one boolean mask drops them all at once. price is already int64 because it is equivalent to BIGINT in athena
+        #(same data type of the target table)
+        valid_records = pc.and_(pc.is_valid(table['price']), pc.is_valid(produced_at))
         
-        #drop records with NULL dates if found
-        df = df.dropna(subset=['produced_at'])
-        
-        df['symbol'] = df['symbol'].astype('object')
+        #the symbols are written to parquet as a dictionary encoded string column (the default of the parquet writer)
+        table = pa.table({'symbol': table['symbol'], 'price': table['price'], 'produced_at': produced_at}).filter(valid_records)
+        bad_records_count = len(valid_records) - table.num_rows
         
         
         logger.info(f"Number of records with bad data: {bad_records_count}")
         
-        etl_loading_ts = pd.to_datetime(datetime.now())
-        df['etl_loading_ts'] = etl_loading_ts
-        df['p_year'] = df['produced_at'].dt.year  #create the partition
+        #etl_loading_ts is the same for all the records, it is only added to the arrow tables that get written.
+        #a numpy datetime64 scalar (at the millisecond precision stored in parquet) is filled into the columns
+        #without boxing a pandas Timestamp per row
+        etl_loading_ts = np.datetime64(datetime.now(), 'ms')
+        #create the partition, it is kept next to the table instead of as a column since it is not stored in the files.
+        #int32 holds any year and takes half the memory of the int64 returned by pc.year
+        p_years = pc.year(table['produced_at']).cast(pa.int32())
         
     except Exception as e:
         logger.error(f'Error when applying transformations {type(e).__name__} - {e}')
         raise #terminate the program
     
-    #write the file as parquet to the destination bucket
+    """
+    the latest price per symbol is calculated incrementally instead of running a window function over the whole
+    stream_prices_history: the latest record per symbol of this batch is compared with the previous snapshot
+    (latest_prices holds one row per symbol, so reading it is cheap) and replaces it only when it is newer.
+    symbols that are not in this batch keep their previous latest price
+    """
+    #the sort is stable and the ordered group by (use_threads=False) takes the last record of every symbol,
+    #so the latest record per symbol is picked in arrow and only one row per symbol is converted to pandas
+    batch_latest = (table.sort_by('produced_at')
+                         .group_by('symbol', use_threads = False)
+                         .aggregate([('price', 'last'), ('produced_at', 'last')]))
+    batch_latest = pa.table({'symbol': batch_latest['symbol'],
+                             'price': batch_latest['price_last'],
+                             'produced_at': batch_latest['produced_at_last']}).to_pandas()
     
-    try:
-        wr.s3.to_parquet(df = df, path = dest_bucket_path,
-                            dataset=True, #This is done to enable other arguments of the function to_parquet such as partition_cols
-                            mode='append', #add new records without any overwrite or updates
-                            partition_cols=['p_year'])
-    except Exception as e:
-            logger.error(f'Error when writing the file to {dest_bucket_path} {type(e).__name__} - {e}')
-            raise #terminate the program
+    def update_latest_prices():
+        """
+        several invocations can run at the same time, so the snapshot is updated with an optimistic lock:
+        it is read together with its ETag and written back only if it still has that ETag (IfMatch, or IfNoneMatch='*'
+        when the file does not exist yet). if another invocation replaced it in between, S3 rejects the write
+        (412 PreconditionFailed, or 409 ConditionalRequestConflict when both writes arrive at the same time) and the
+        batch is merged again with the new snapshot, so the newer prices written by the other invocation are kept.
+        returns whether the snapshot was overwritten
+        """
+        for attempt in range(latest_max_attempts):
+            try:
+                #the previous snapshot is read straight from the parquet file this function overwrites (the data of latest_prices)
+                #instead of running an athena query
+                response = s3_client.get_object(Bucket = latest_bucket, Key = latest_key)
+                write_condition = {'IfMatch': response['ETag']}
+                df_prior_latest = pa_pq.read_table(io.BytesIO(response['Body'].read()),
+                                                   columns = ['symbol', 'price', 'produced_at']).to_pandas()
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchKey':
+                    raise
+                
+                #the file does not exist yet the first time the function runs
+                logger.warning(f'No previous latest prices found in {dest_bucket_path_overwrite}')
+                write_condition = {'IfNoneMatch': '*'}
+                df_prior_latest = batch_latest.iloc[0:0]
+            
+            #the batch comes first and the sort is stable, so on equal produced_at keep='last' keeps the previous snapshot
+            #and a symbol is only replaced when the batch has a strictly more recent record
+            df_latest = pd.concat([batch_latest, df_prior_latest], ignore_index = True)
+            df_latest = df_latest.sort_values('produced_at', kind = 'stable').drop_duplicates('symbol', keep = 'last')
+            df_latest['etl_loading_ts'] = etl_loading_ts
+            
+            #the rows of the batch come first in the concatenated index, if none of them was kept
+            #(e.g. a late or replayed file) the snapshot is unchanged and is not rewritten
+            if not (df_latest.index < batch_latest.shape[0]).any():
+                logger.info(f'No symbol of the batch is newer than the latest prices in {dest_bucket_path_overwrite}, skipping the overwrite')
+                return False
+            
+            parquet_buffer = io.BytesIO()
+            pa_pq.write_table(pa.Table.from_pandas(df_latest, preserve_index = False), parquet_buffer,
+                              coerce_timestamps = 'ms', allow_truncated_timestamps = True)
+            
+            try:
+                s3_client.put_object(Bucket = latest_bucket, Key = latest_key, Body = parquet_buffer.getvalue(), **write_condition)
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+                
+                logger.warning(f'The latest prices in {dest_bucket_path_overwrite} were replaced by another invocation, '
+                               f'merging the batch again (attempt {attempt + 1})')
         
+        raise RuntimeError(f'The latest prices in {dest_bucket_path_overwrite} kept changing, '
+                           f'the batch could not be merged after {latest_max_attempts} attempts')
+    
+    def upload_history():
+        """
+        the records are appended to the p_year=YYYY folders of the destination path (the same layout partition_cols=['p_year']
+        creates). every partition is written to parquet in memory and uploaded with boto3's transfer manager,
+        instead of the 5 MiB parts awswrangler used, transfer_config uploads big files as concurrent 16 MiB parts.
+        a new file name is generated for every upload, so existing files are never overwritten (append)
+        """
+        #the path may or may not end with a slash and may be the root of the bucket (s3://bucket),
+        #the prefix is either empty or ends with exactly one slash so the p_year=YYYY folders are always under it
+        dest_bucket, _, dest_prefix = dest_bucket_path.removeprefix('s3://').partition('/')
+        dest_prefix = dest_prefix.rstrip('/') + '/' if dest_prefix.rstrip('/') else ''
         
-    latest_prices_query =  'select symbol, price, produced_at \
-                            from \
-                            ( \
-                                select symbol, price, produced_at , row_number() over(partition by symbol order by produced_at desc) ranking\
-                                from stream_prices_history\
-                                where p_year = year(produced_at)\
-                            ) a \
-                            where ranking = 1;\
-                            '
+        for p_year in pc.unique(p_years).to_pylist():
+            #pa.repeat creates the etl_loading_ts column from a single value at write time instead of
+            #keeping it as an extra column of the whole table during the transformations
+            partition_table = table.filter(pc.equal(p_years, p_year))
+            partition_table = partition_table.append_column('etl_loading_ts',
+                                                            pa.repeat(pa.scalar(etl_loading_ts, type = pa.timestamp('ms')), partition_table.num_rows))
+            
+            for offset in range(0, partition_table.num_rows, max_rows_per_file):
+                parquet_buffer = io.BytesIO()
+                pa_pq.write_table(partition_table.slice(offset, max_rows_per_file), parquet_buffer,
+                                  coerce_timestamps = 'ms', allow_truncated_timestamps = True)
+                parquet_buffer.seek(0)
+                
+                s3_client.upload_fileobj(parquet_buffer, dest_bucket, f'{dest_prefix}p_year={p_year}/{uuid.uuid4().hex}.snappy.parquet',
+                                         Config = transfer_config)
     
-    try: 
-        df_athena = wr.athena.read_sql_query(sql = latest_prices_query, database = 'stock_market')
-        df_athena['etl_loading_ts'] = etl_loading_ts
+    #write the history files and the latest snapshot to the destination buckets
+    #they do not depend on each other, so both uploads run at the same time and the S3 latency is only paid once
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        history_upload = executor.submit(upload_history)
+        latest_upload = executor.submit(update_latest_prices)
+    
+    try:
+        history_upload.result()
     except Exception as e:
-        logger.error(f'Error when reading data using athena {type(e).__name__} - {e}')
-        raise 
+            logger.error(f'Error when writing the file to {dest_bucket_path} {type(e).__name__} - {e}')
+            raise #terminate the program
     
     try:
-        wr.s3.to_parquet(
-                        df = df_athena,
-                         path = dest_bucket_path_overwrite
-                         )                   
+        latest_written = latest_upload.result()
     except Exception as e:
-            logger.error(f'Error when writing the file to {dest_bucket_path_overwrite} {type(e).__name__} - {e}')
+            logger.error(f'Error when updating the latest prices in {dest_bucket_path_overwrite} {type(e).__name__} - {e}')
             raise #terminate the program       
 
+    #the number of appended records is the same in both branches, only the status and the log messages differ
+    records_appended = table.num_rows
+    
+    #the snapshot is left as is when no symbol of the batch is newer (e.g. a replayed file or only bad records)
+    if latest_written:
+        latest_message = 'overritten in stock_market.price_by_date_latest'
+    else:
+        latest_message = 'stock_market.price_by_date_latest was left unchanged'
+    
     if bad_records_count == 0:
-        end_time = datetime.now()
-        duration = round((end_time - start_time).total_seconds(),0)
-        
-        logger.info(f'all records ({df.shape[0]}) got appended successfully to the tables stock_market.price_by_date_streams.\
-                    and overritten in stock_market.price_by_date_latest. Total time taken: {duration} seconds. ETL job will exit.')
-                    
-        return {
-        "status": "success",
-        "records_appended": df.shape[0],
-        "duration_seconds": duration
-                }
+        summary = job_summary("success", records_appended, start_time)
+        
+        logger.info(f'all records ({records_appended}) got appended successfully to the table stock_market.price_by_date_streams.\
+                    and {latest_message}. Total time taken: {summary["duration_seconds"]} seconds. ETL job will exit.')
         
     else:
         logger.warning(f'destination records are less than the source records by {bad_records_count}')
         
-        end_time = datetime.now()
-        duration = round((end_time - start_time).total_seconds(),0)
+        summary = job_summary("success with warning", records_appended, start_time)
         
-        logger.info(f'{df.shape[0]}/{df.shape[0] + bad_records_count} records  got appended successfully \
-        to the tables stock_market.price_by_date_streams and overritten in stock_market.price_by_date_latest. \
-        Total time taken: {duration} seconds. ETL job will exit.')
-                
-        return {
-        "status": "success with warning",
-        "records_appended": df.shape[0],
-        "duration_seconds": duration
-                }
\ No newline at end of file
+        logger.info(f'{records_appended}/{records_appended + bad_records_count} records  got appended successfully \
+        to the table stock_market.price_by_date_streams and {latest_message}. \
+        Total time taken: {summary["duration_seconds"]} seconds. ETL job will exit.')
+    
+    return summary
\ No newline at end of file
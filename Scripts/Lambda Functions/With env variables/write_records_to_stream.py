@@ -1,60 +1,10 @@
-    """
-    Function Overview:
-    ------------------
-    This function pushes a simulated batch of stock price records to an Amazon Kinesis Data Stream. 
-    The data is first generated using the `create_stock_market_data()` function, then encoded, and 
-    finally sent to the stream in batch using the `put_records` API.
-
-    Each record includes:
-    - stock symbol
-    - randomly generated price (+/- 10% of a base value)
-    - record generation timestamp
-
-    Records are newline-separated and UTF-8 encoded to ensure compatibility with downstream consumers
-    like Amazon Kinesis Firehose and S3.
-
-    Libraries used:
-    - boto3: For interfacing with the AWS Kinesis Data Stream
-    - json: For serializing records to JSON
-    - logging: For structured logging
-    - datetime: For timestamping records
-
-    Parameters:
-    -----------
-    records : list
-        List of stock record dictionaries to be published.It's Generated using 
-        the function via `create_stock_market_data().
-    
-    event : dict
-        AWS Lambda event input ( AWS Lambda always passes it automatically when the function is invoked)
-
-    context : object, optional
-        AWS Lambda context object (default is None)
-
-    Environment Variables:
-    ----------------------
-    stream_name : str
-        Name of the Kinesis Data Stream to which records will be pushed.
-        Example: "stock-stream-raw"
-
-    Returns:
-    --------
-    dict
-        {
-            'FailedRecordCount': int,
-            'SuccessRecordCount': int
-        }
-
-    Notes:
-    ------
-    - All records in the batch share the same `produced_at` timestamp.
-    - A newline `\n` is added to each record to simplify parsing when data lands in flat-file storage.
-    - The partition key is set to the stock symbol to evenly distribute across shards.
-    - Logging captures batch success/failure count and runtime duration for monitoring.
-    """
 import boto3
 import os
-from datetime import datetime, timedelta
+import json
+import uuid
+import time
+import numpy as np
+from datetime import datetime
 import logging
 
 
@@ -100,65 +50,70 @@ else:
         datefmt="%Y-%m-%d %H:%M:%S"
     )   
 
-try: 
-    stream_name = os.environ['stream_name']
-except Exception as e:
-        logger.error(f'Error when retrieving the input variable of the stream_name {type(e).__name__} - {e}')
-        raise #terminate the program 
+#read once when the lambda container starts, a missing variable fails the cold start with a KeyError
+stream_name = os.environ['stream_name']
+
+#put_records accepts at most 500 records per call, the records it rejects (e.g. throttling) are sent again
+#up to put_records_max_attempts times in total with an exponential backoff between the attempts
+put_records_batch_size = 500
+put_records_max_attempts = 5
+
+#several newline delimited records are packed into one kinesis record of at most 10 KiB,
+#500 of those (plus their partition keys) stay under the 5 MiB limit of one put_records call
+kinesis_record_max_bytes = 10 * 1024
+
 
 
 
+#get the current stock prices of some companies on 25/01/2025
+companies_price = {
+                    'NVDA': 143,
+                    'AAPL': 223,
+                    'MSFT': 444,
+                    'AMZN': 234,
+                    'GOOGL': 200,
+                    'META': 647,
+                    'TSLA': 407,
+                    'WMT': 95,
+                    'JPM': 265,
+                    'V': 330,
+                    'ORCL': 184,
+                    'MA': 490,
+                    'XOM': 109,
+                    'NFLX': 978,
+                    'PG': 164,
+                    'SAP': 276
+                    }
+
+symbols = tuple(companies_price.keys())
+current_prices = np.array(list(companies_price.values()), dtype=np.int64)
+
+#create a min and max price for each current price by adding and removing 10% from the current price
+#they are computed once per lambda container, astype truncates like int() did so the ranges are the same as before
+min_prices = (current_prices * 0.9).astype(np.int64)
+max_prices = (current_prices * 1.1).astype(np.int64)
+
+#numpy's Generator (PCG64) is created once per lambda container, it draws the sampled companies and their prices
+rng = np.random.default_rng()
+
 
 #this function generates simulated stock prices for a set of companies using a random range (+/-10%) of the current price
 #it returns a list of dictionaries, each item in the list is a dictionary that contains the symbol name and the price
 
 def create_stock_market_data():
 
-    from random import randrange, sample
+    #pick between 5 and 15 distinct companies in a random order, only their prices are generated
+    sampled = rng.choice(len(symbols), size = rng.integers(5, 16), replace = False)
     
+    #generate a new random price between the min (inclusive) and the max (exclusive) price of every sampled company in one call
+    prices = rng.integers(min_prices[sampled], max_prices[sampled])
     
-    #get the current stock prices of some companies on 25/01/2025
-    companies_price = {
-                        'NVDA': {'current_price':143},
-                        'AAPL': {'current_price':223},
-                        'MSFT': {'current_price':444},
-                        'AMZN': {'current_price':234},
-                        'GOOGL': {'current_price':200},
-                        'META': {'current_price':647},
-                        'TSLA': {'current_price':407},
-                        'WMT': {'current_price':95},
-                        'JPM': {'current_price':265},
-                        'V': {'current_price':330},
-                        'ORCL': {'current_price':184},
-                        'MA': {'current_price':490},
-                        'XOM': {'current_price':109},
-                        'NFLX': {'current_price':978},
-                        'PG': {'current_price':164},
-                        'SAP': {'current_price':276}
-                        }
+    #all the records of the batch share the same timestamp, so it is formatted once
+    produced_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    
-    stock_data = []
-    
-    for k in companies_price:
-        
-        #create a min and max price for each current price by adding and removing 10% from the current price
-        companies_price[k]['min_price'] = int(companies_price[k]['current_price'] * 0.9)
-        companies_price[k]['max_price'] = int(companies_price[k]['current_price'] * 1.1)
-        
-        #generate a new random current price between the min and the max price
-        companies_price[k]['current_price'] = randrange(companies_price[k]['min_price'], companies_price[k]['max_price'])
-        
-        #delete the keys min_price, max_price since they're not needed anymore
-        del companies_price[k]['min_price'] 
-        del companies_price[k]['max_price']
-        
-        current_timestamp = datetime.now()
-        
-        stock_data.append({'symbol': k, 'price': companies_price[k]['current_price'], 
-                           'produced_at': current_timestamp.strftime('%Y-%m-%d %H:%M:%S')})
-         
-    stock_data = sample(stock_data, randrange(5,16))
+    #tolist converts the numpy integers to python integers that json can serialize
+    stock_data = [{'symbol': symbols[i], 'price': price, 'produced_at': produced_at}
+                  for i, price in zip(sampled.tolist(), prices.tolist())]
         
     return stock_data
 
@@ -166,8 +121,66 @@ def create_stock_market_data():
 #encodes it (change from string to bytes), then pushes it into a stream
 
 def write_records_to_stream(records, event, context = None):
+    """
+    Function Overview:
+    ------------------
+    This function pushes a simulated batch of stock price records to an Amazon Kinesis Data Stream. 
+    The data is first generated using the `create_stock_market_data()` function, then encoded, and 
+    finally sent to the stream in batch using the `put_records` API.
+
+    Each record includes:
+    - stock symbol
+    - randomly generated price (+/- 10% of a base value)
+    - record generation timestamp
+
+    Records are newline-separated and UTF-8 encoded to ensure compatibility with downstream consumers
+    like Amazon Kinesis Firehose and S3.
+
+    Libraries used:
+    - boto3: For interfacing with the AWS Kinesis Data Stream
+    - numpy: For sampling the companies and generating their random prices at once
+    - json: For serializing records to JSON
+    - logging: For structured logging
+    - datetime: For timestamping records
+
+    Parameters:
+    -----------
+    records : list
+        List of stock record dictionaries to be published.It's Generated using 
+        the function via `create_stock_market_data().
     
-    import json
+    event : dict
+        AWS Lambda event input ( AWS Lambda always passes it automatically when the function is invoked)
+
+    context : object, optional
+        AWS Lambda context object (default is None)
+
+    Environment Variables:
+    ----------------------
+    stream_name : str
+        Name of the Kinesis Data Stream to which records will be pushed.
+        Example: "stock-stream-raw"
+
+    Returns:
+    --------
+    dict
+        {
+            'FailedRecordCount': int,
+            'SuccessRecordCount': int
+        }
+
+    Notes:
+    ------
+    - All records in the batch share the same `produced_at` timestamp.
+    - A newline `\n` is added to each record to simplify parsing when data lands in flat-file storage.
+    - The newline delimited records are packed together into Kinesis records of at most 10 KiB, so one batch
+      costs one put_records entry instead of one per symbol. Firehose writes the bytes as they are, so the files
+      on S3 keep one json record per line and no de-aggregation is needed downstream.
+    - The partition key is a random uuid so the records are spread evenly across all the shards
+      (the 16 symbols would hash to only a few of them).
+    - Kinesis records are sent in batches of at most 500, and only the ones rejected by Kinesis are retried (with backoff).
+    - Logging captures batch success/failure count and runtime duration for monitoring.
+    """
     
     
     try:
@@ -178,8 +191,6 @@ def write_records_to_stream(records, event, context = None):
         logger.error(f'Error when generating the input data list: {type(e).__name__} - {e}')
         raise #terminate the program
             
-    encoded_records = [] #this empty list will contain the encoded list
-    
     """
     for each record, convert the data from a dictionary to json to be able to encode it.
     before converting to json, a new line is added manually at the end of each list element because
@@ -192,18 +203,54 @@ def write_records_to_stream(records, event, context = None):
     computers and services like Kinesis expect. It is stated in the documentation of the function put_records that
     data should be in bytes
     Creating the partition key is necessary since all data records with the same partition key
-    map to the same shard(partition) within the stream(topic).
+    map to the same shard(partition) within the stream(topic). A random uuid is used instead of the symbol
+    so that the records are spread over all the shards, the consumers do not rely on the order per symbol.
+    separators=(',', ':') writes compact json without the default spaces, and the new line is appended to the
+    encoded bytes instead of creating one more string per record
     """
-    for record in records:
-        encoded_records.append(
-                                {'Data': (json.dumps(record) + '\n').encode('utf-8'), #convert each list element to json then encode
-                                'PartitionKey': record['symbol'] #create the partition key for each record
-                                    }
-                                    )
+    encoded_data = [json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n' #convert each list element to json then encode
+                    for record in records]
+    
+    #pack the encoded records into as few kinesis records as possible, the new line at the end of each record
+    #keeps them separated once firehose writes the data to S3
+    encoded_records = []
+    packed_data = []
+    packed_size = 0
+    for data in encoded_data:
+        if packed_data and packed_size + len(data) > kinesis_record_max_bytes:
+            encoded_records.append({'Data': b''.join(packed_data), 'PartitionKey': uuid.uuid4().hex})
+            packed_data = []
+            packed_size = 0
+        packed_data.append(data)
+        packed_size += len(data)
+    
+    if packed_data:
+        encoded_records.append({'Data': b''.join(packed_data), 'PartitionKey': uuid.uuid4().hex})
+    
+    failed_record_count = 0
     
     try:
-        # Send the records batch to Kinesis
-        response = kinesis_client.put_records(Records = encoded_records, StreamName = stream_name)
+        # Send the records to Kinesis in batches of at most 500 records
+        for batch_start in range(0, len(encoded_records), put_records_batch_size):
+            batch = encoded_records[batch_start:batch_start + put_records_batch_size]
+            
+            for attempt in range(put_records_max_attempts):
+                if attempt > 0:
+                    time.sleep(0.1 * 2 ** (attempt - 1))
+                
+                response = kinesis_client.put_records(Records = batch, StreamName = stream_name)
+                
+                if response['FailedRecordCount'] == 0:
+                    batch = []
+                    break
+                
+                #the records of the response are in the same order as the request, only the failed ones are sent again
+                #so the records that were already accepted are not duplicated in the stream
+                batch = [record for record, result in zip(batch, response['Records']) if 'ErrorCode' in result]
+                logger.warning(f'{len(batch)} kinesis records were rejected by the stream {stream_name} (attempt {attempt + 1})')
+            
+            #the kinesis records still rejected after the last attempt, each stock record inside them ends with a new line
+            failed_record_count += sum(record['Data'].count(b'\n') for record in batch)
     except Exception as e:
         logger.error(f'Error when pushing the data to the stream {stream_name} {type(e).__name__} - {e}')
         raise #terminate the program
@@ -214,5 +261,5 @@ def write_records_to_stream(records, event, context = None):
     logger.info(f'number of records that should enter the stream {stream_name} at {records[0]["produced_at"]} \
     are:  {len(records)}. Total time taken: {duration} seconds. ETL job will exit.')
     
-    return {'FailedRecordCount': response['FailedRecordCount'],
-            'SuccessRecordCount': len(records)}
+    return {'FailedRecordCount': failed_record_count,
+            'SuccessRecordCount': len(records) - failed_record_count}
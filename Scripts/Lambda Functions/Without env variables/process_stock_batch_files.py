@@ -1,7 +1,6 @@
 def process_batch_files_lambda(event, context):
     
     import pandas as pd
-    from datetime import datetime, timedelta
     from random import randrange
     import awswrangler as wr
 
@@ -11,16 +10,18 @@ def process_batch_files_lambda(event, context):
     path = source_bucket + key
     
     df_new_file = wr.s3.read_csv(path)
-    df_new_file['date'] = df_new_file['date'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d').date()) 
+    df_new_file['date'] = pd.to_datetime(df_new_file['date'], format='%Y-%m-%d', cache=True).dt.date #parse the whole column at once instead of one strptime per row
     
     df_athena = wr.athena.read_sql_query('SELECT * FROM price_by_date', database = 'stock_market')
     
-    # Perform the left join and get records in df_new_file and not in df_athena
-    merged_df = pd.merge(df_new_file, df_athena, how='left', left_on=['company', 'date'], right_on=['company', 'close_date'] )
-    df_new_records = merged_df[merged_df['close_price_y'].isnull()][['company', 'date', 'close_price_x']]
+    # Get the records in df_new_file and not in df_athena (anti join on the (company, date) pairs)
+    # isin on a MultiIndex is a hash lookup, unlike a left join it does not build a merged copy of both dataframes
+    new_keys = pd.MultiIndex.from_arrays([df_new_file['company'], df_new_file['date']])
+    existing_keys = pd.MultiIndex.from_arrays([df_athena['company'], df_athena['close_date']])
+    df_new_records = df_new_file.loc[~new_keys.isin(existing_keys), ['company', 'date', 'close_price']]
     df_new_records.columns = ['company', 'close_date', 'close_price']
     
-    df_new_records['p_year'] = pd.to_datetime(df_new_records['close_date']).dt.year
+    df_new_records['p_year'] = df_new_records['close_date'].to_numpy().astype('datetime64[Y]').astype('int32') + 1970 #years since 1970 + 1970, without the .dt accessor
     
     dest_path = 's3://stock-market-raw-data-us-east-1/price_by_date/'
 
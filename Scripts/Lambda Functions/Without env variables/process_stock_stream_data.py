@@ -4,6 +4,7 @@ def process_stock_stream_data(event, context):
     import boto3
     import awswrangler as wr
     import pandas as pd
+    import numpy as np
     from datetime import datetime
     
     #get the source path of the json file that will be read
@@ -16,9 +17,9 @@ def process_stock_stream_data(event, context):
     
     #Apply Transformations
     df['price'] = df['price'].astype(int)
-    df['produced_at'] = pd.to_datetime(df['produced_at'])
-    df['etl_loading_ts'] = datetime.now()
-    df['p_year'] = df['produced_at'].dt.year  #create the partition
+    df['produced_at'] = pd.to_datetime(df['produced_at'], format='%Y-%m-%d %H:%M:%S', cache=True) #the format of write_records_to_stream, parsed without inferring it
+    df['etl_loading_ts'] = np.datetime64(datetime.now(), 'ms') #one numpy scalar filled into the column
+    df['p_year'] = df['produced_at'].to_numpy().astype('datetime64[Y]').astype('int32') + 1970  #create the partition (years since 1970 + 1970), int32 is enough for a year
     
     #write the file as parquet to the destination bucket
     wr.s3.to_parquet(df = df, path ='s3://stock-market-raw-data-us-east-1/price_by_date_stream/',